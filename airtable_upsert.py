@@ -1,77 +1,379 @@
 #!/usr/bin/env python3
-import argparse, csv, json, sys, time
-from typing import List, Dict
-import requests
+import argparse, asyncio, contextlib, csv, io, mmap, multiprocessing, os, random, stat, sys, time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional
+import httpx
+import orjson
 from urllib.parse import quote
 
-def chunked(seq, size):
-    for i in range(0, len(seq), size):
-        yield seq[i:i+size]
+MAX_CONCURRENCY = 5          # ceiling on in-flight requests for AdaptiveLimiter
+MAX_RPS = 5                  # Airtable allows 5 req/s per base; enforced by RateGate
+RATE_LIMIT_PAUSE = 30.0      # Airtable locks a base for 30s after a 429, usually without Retry-After
+MAX_IN_FLIGHT = 2 * MAX_CONCURRENCY   # batches read ahead of the limiter
+RETRY_STATUS = {429, 500, 502, 503, 504}
+JSON_HEADERS = {"Content-Type": "application/json"}
+KEEPALIVE_TIMEOUT = 60.0              # longer than any retry backoff
+PARALLEL_CSV_CHUNK = 8 << 20          # bytes per worker chunk for --csv-engine mmap
+THREAD_READAHEAD = 500                # items pulled per hop to the CSV reader thread
 
-def load_csv(path: str) -> List[Dict]:
-    with open(path, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        rows = [ {k: (v if v != "" else None) for k, v in row.items()} for row in reader ]
-        print("[info] CSV headers:", list(reader.fieldnames or []))
-    return rows
-
-def ensure_unique_key(rows: List[Dict], unique_field: str) -> None:
-    """If unique_field missing, try to synthesize Enrollment Course Key from 3 columns."""
-    if not rows:
-        return
-    have_field = unique_field in rows[0]
-    if have_field and any(r.get(unique_field) for r in rows):
-        return  # fine
+def chunked(iterable, size):
+    it = iter(iterable)
+    while batch := list(islice(it, size)):
+        yield batch
+
+def fill_shells(shells: List[Dict], key: str, values: List) -> List[Dict]:
+    """Point reusable record shells at values; they are overwritten by the next call."""
+    for shell, v in zip(shells, values):
+        shell[key] = v
+    return shells[:len(values)]
 
+def missing_key_error(headers: List[str], unique_field: str) -> SystemExit:
+    return SystemExit(
+        f"[fatal] Unique field '{unique_field}' not found and cannot synthesize.\n"
+        f"CSV columns: {headers}\n"
+        f"Either add '{unique_field}' to your CSV or ensure the CSV has columns "
+        f"'Student Canvas ID', 'School Year', and 'Course ID' so I can build it."
+    )
+
+def unique_key_synthesizer(headers: List[str], unique_field: str, log: bool = True) -> Optional[Callable[[Dict], None]]:
+    """Return a per-row fixer that synthesizes Enrollment Course Key from 3 columns, or None."""
     # Try to build it from Student Canvas ID + School Year + Course ID
     needed = ["Student Canvas ID", "School Year", "Course ID"]
-    if all(needed[0] in rows[0] for _ in [None]) and all(k in rows[0] for k in needed):
-        for r in rows:
+    if all(k in headers for k in needed):
+        warned = not log
+
+        def fix(r: Dict) -> None:
+            nonlocal warned
+            if r.get(unique_field):
+                return  # fine
             sid = (r.get("Student Canvas ID") or "").strip()
             year = (r.get("School Year") or "").strip()
             cid = (r.get("Course ID") or "").strip()
             if sid and year and cid:
                 r[unique_field] = f"{sid}-{year}-{cid}"
-        print(f"[warn] '{unique_field}' was missing/empty; synthesized from {needed}.")
-    else:
+                if not warned:
+                    print(f"[warn] '{unique_field}' was missing/empty; synthesizing from {needed}.")
+                    warned = True
+        return fix
+
+    if unique_field not in headers:
         # If we cannot synthesize, fail with a clear message
-        hdrs = list(rows[0].keys())
-        raise SystemExit(
-            f"[fatal] Unique field '{unique_field}' not found and cannot synthesize.\n"
-            f"CSV columns: {hdrs}\n"
-            f"Either add '{unique_field}' to your CSV or ensure the CSV has columns "
-            f"'Student Canvas ID', 'School Year', and 'Course ID' so I can build it."
-        )
-
-def upsert_to_airtable(base_id: str, table_name: str, token: str,
-                       csv_path: str, unique_field: str, typecast: bool):
-    rows = load_csv(csv_path)
-    if not rows:
-        print(f"[warn] No rows in {csv_path}; nothing to upsert.")
+        raise missing_key_error(headers, unique_field)
+    return None
+
+def clean_rows(reader: Iterator[List[str]], headers: List[str]) -> Iterator[Dict]:
+    """Build row dicts from csv.reader lists ('' -> None), padding short rows like DictReader."""
+    n = len(headers)
+    for row in reader:
+        if not row:
+            continue
+        if len(row) < n:
+            row += [None] * (n - len(row))
+        yield {k: (v or None) for k, v in zip(headers, row)}
+
+def _iter_csv_python(path: str) -> Iterator[Dict]:
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        # Interned header names are shared as dict keys by every row
+        headers = [sys.intern(h) for h in next(reader, [])]
+        yield headers
+        yield from clean_rows(reader, headers)
+
+def _parse_csv_range(path: str, start: int, end: int, headers: List[str]) -> List[Dict]:
+    """Worker: parse bytes [start, end) of the file (whole lines) into cleaned rows."""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        text = mm[start:end].decode("utf-8")
+    headers = [sys.intern(h) for h in headers]
+    return list(clean_rows(csv.reader(io.StringIO(text, newline="")), headers))
+
+def _iter_csv_parallel(path: str) -> Iterator[Dict]:
+    """Parse line-aligned chunks in worker processes; assumes no quoted field contains a newline."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            header_end = mm.find(b"\n")
+            header_end = size if header_end < 0 else header_end + 1
+            headers = next(csv.reader([mm[:header_end].decode("utf-8")]), [])
+            ranges = []
+            start = header_end
+            while start < size:
+                nl = mm.find(b"\n", min(start + PARALLEL_CSV_CHUNK, size) - 1)
+                end = size if nl < 0 else nl + 1
+                ranges.append((start, end))
+                start = end
+    yield headers
+
+    workers = os.cpu_count() or 1
+    # Runs on the CSV reader thread beside the event loop; forking a multi-threaded process can deadlock
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver")) as ex:
+        window = deque()
+        ranges = iter(ranges)
+        for start, end in islice(ranges, 2 * workers):
+            window.append(ex.submit(_parse_csv_range, path, start, end, headers))
+        while window:
+            rows = window.popleft().result()
+            for start, end in islice(ranges, 1):
+                window.append(ex.submit(_parse_csv_range, path, start, end, headers))
+            yield from rows
+
+def _iter_csv_arrow(path: str) -> Iterator[Dict]:
+    """Stream rows via pyarrow; unlike the other engines, a short row is fatal."""
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as pv
+    except ImportError:
+        raise SystemExit("[fatal] --csv-engine arrow needs pyarrow (pip install pyarrow).")
+
+    with open(path, newline="", encoding="utf-8") as f:
+        headers = next(csv.reader(f), [])
+    yield headers
+    if not headers:
         return
 
-    ensure_unique_key(rows, unique_field)
+    convert = pv.ConvertOptions(column_types={h: pa.string() for h in headers},
+                                null_values=[""], strings_can_be_null=True)
+    try:
+        # Quoted fields may span lines, as the csv module allows
+        parse = pv.ParseOptions(newlines_in_values=True)
+        with pv.open_csv(path, parse_options=parse, convert_options=convert) as reader:
+            for record_batch in reader:
+                yield from record_batch.to_pylist()
+    except pa.ArrowInvalid as e:
+        raise SystemExit(f"[fatal] --csv-engine arrow could not parse {path}: {e}\n"
+                         f"Use --csv-engine python, which pads short rows with empty values.")
+
+def iter_csv(path: str, unique_field: str, engine: str = "python", log: bool = True) -> Iterator[Dict]:
+    """Stream cleaned rows, synthesizing unique_field where empty and skipping rows without one."""
+    if engine != "python" and not is_regular_file(path):
+        raise SystemExit(f"[fatal] --csv-engine {engine} needs a regular file; use --csv-engine python for {path}.")
+    rows = CSV_ENGINES[engine](path)
+    headers = next(rows, [])
+    if log:
+        print("[info] CSV headers:", headers)
+    fix = unique_key_synthesizer(headers, unique_field, log=log) if headers else None
+    kept, skipped = 0, 0
+    for r in rows:
+        if fix:
+            fix(r)
+        if not r.get(unique_field):
+            skipped += 1
+            continue
+        kept += 1
+        yield r
+    if skipped and not kept:
+        raise missing_key_error(headers, unique_field)
+    if skipped and log:
+        print(f"[warn] Skipped {skipped} rows with no '{unique_field}' value.")
+
+def is_regular_file(path: str) -> bool:
+    """False for pipes and other inputs (e.g. /dev/stdin) that can only be read once."""
+    try:
+        return stat.S_ISREG(os.stat(path).st_mode)
+    except OSError:
+        return True  # let the open() in the reader report it
+
+def dedupe_last(make_rows: Callable[[bool], Iterator[Dict]], key_of: Callable[[Dict], Optional[str]],
+                reread: bool = True) -> Iterator[Dict]:
+    """Yield only the last row for each key; reread parses twice to hold keys, not rows."""
+    total = 0
+    if not reread:
+        rows: Dict = {}
+        for total, r in enumerate(make_rows(True), start=1):
+            slot = key_of(r) or ("", total)  # keyless rows get a slot no key can collide with
+            rows.pop(slot, None)
+            rows[slot] = r
+        kept = len(rows)
+        yield from rows.values()
+    else:
+        last: Dict[str, int] = {}
+        for total, r in enumerate(make_rows(True), start=1):
+            k = key_of(r)
+            if k:
+                last[k] = total
+        kept = 0
+        for i, r in enumerate(make_rows(False), start=1):
+            k = key_of(r)
+            if not k or last.get(k) == i:
+                kept += 1
+                yield r
+    if total - kept:
+        print(f"[info] Deduplicated {total - kept} rows sharing a unique key (kept the last of each).")
+
+async def iter_in_thread(items: Iterator, readahead: int = THREAD_READAHEAD) -> AsyncIterator:
+    """Drain a blocking iterator on a worker thread, readahead items per hop."""
+    loop = asyncio.get_running_loop()
+    # One worker: the iterator is stateful and must only be advanced by one thread at a time
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="csv") as ex:
+        def next_block() -> List:
+            return list(islice(items, readahead))
+        pending = loop.run_in_executor(ex, next_block)
+        while block := await pending:
+            pending = loop.run_in_executor(ex, next_block)
+            for item in block:
+                yield item
+
+CSV_ENGINES = {"python": _iter_csv_python, "mmap": _iter_csv_parallel, "arrow": _iter_csv_arrow}
 
+class ServiceOverloadError(Exception):
+    """Airtable answered 429/5xx; treated as a congestion signal by AdaptiveLimiter."""
+    def __init__(self, status: int, text: str, retry_after: Optional[str] = None):
+        super().__init__(f"{status} {text[:500]}")
+        self.status = status
+        self.retry_after = retry_after
+
+class RateGate:
+    """Spaces request starts at least 1/rate seconds apart across every task sharing it."""
+    def __init__(self, rate: float = MAX_RPS):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+
+    async def wait(self) -> None:
+        now = time.monotonic()
+        start = max(now, self._next)
+        self._next = start + self.interval  # reserve the slot before sleeping
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def hold(self, seconds: float) -> None:
+        """Admit no request for the next seconds (e.g. while a 429 lockout runs out)."""
+        self._next = max(self._next, time.monotonic() + seconds)
+
+class AdaptiveLimiter:
+    """AIMD in-flight window (halved at most once per window) under a MAX_RPS RateGate."""
+    def __init__(self, initial: int = 2, min_limit: int = 1, max_limit: int = MAX_CONCURRENCY,
+                 rate: float = MAX_RPS):
+        self.limit = float(initial)
+        self.gate = RateGate(rate)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self._inflight = 0
+        self._sent = 0       # requests admitted so far
+        self._cut_at = 0     # value of _sent when the window was last halved
+        self._cond = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def use(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._inflight < int(self.limit))
+            self._inflight += 1
+            self._sent += 1
+            seq = self._sent
+        try:
+            yield
+        except ServiceOverloadError:
+            if seq > self._cut_at:
+                self.limit = max(float(self.min_limit), self.limit / 2)
+                self._cut_at = self._sent
+            raise
+        else:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+        finally:
+            async with self._cond:
+                self._inflight -= 1
+                self._cond.notify_all()
+
+def open_session(headers: Dict[str, str]) -> httpx.AsyncClient:
+    """One pooled HTTP/2 client per run; concurrent batches multiplex over warm TLS connections."""
+    limits = httpx.Limits(max_connections=10, max_keepalive_connections=10,
+                          keepalive_expiry=KEEPALIVE_TIMEOUT)
+    return httpx.AsyncClient(http2=True, headers=headers, limits=limits, timeout=120,
+                             follow_redirects=True)
+
+async def request_json(session: httpx.AsyncClient, limiter: AdaptiveLimiter, method: str,
+                       url: str, label: str, body: Optional[bytes] = None,
+                       params: Optional[Dict] = None, max_retries: int = 5) -> Dict:
+    """Make one Airtable call through the limiter, backing off on overload; raises RuntimeError."""
+    headers = JSON_HEADERS if body is not None else None
+    delay = 1.0
+    for attempt in range(1, max_retries + 1):
+        try:
+            async with limiter.use():
+                await limiter.gate.wait()
+                resp = await session.request(method, url, content=body, params=params, headers=headers)
+                if resp.status_code in RETRY_STATUS:
+                    raise ServiceOverloadError(resp.status_code, resp.text, resp.headers.get("Retry-After"))
+                if resp.is_error:
+                    raise RuntimeError(f"{resp.status_code} {resp.text[:500]}")
+                return resp.json()
+        except ServiceOverloadError as e:
+            if attempt == max_retries:
+                raise RuntimeError(str(e)) from e
+            wait = delay
+            if e.retry_after:
+                try:
+                    wait = max(wait, float(e.retry_after))
+                except ValueError:
+                    pass
+            elif e.status == 429:
+                wait = max(wait, RATE_LIMIT_PAUSE)
+            wait += random.uniform(0, wait / 2)
+            if e.status == 429:
+                limiter.gate.hold(wait)
+            print(f"[warn] {label}: HTTP {e.status} on attempt {attempt} "
+                  f"(window {limiter.limit:.1f}); retrying in {wait:.1f}s")
+            await asyncio.sleep(wait)
+            delay = min(delay * 2, 30.0)
+
+async def send_batch(session: httpx.AsyncClient, limiter: AdaptiveLimiter, method: str,
+                     url: str, body: bytes, label: str) -> int:
+    """Send one pre-serialized JSON batch; returns the number of records Airtable echoed back."""
+    data = await request_json(session, limiter, method, url, label, body=body)
+    return len(data.get("records", []))
+
+async def upsert_to_airtable(base_id: str, table_name: str, token: str,
+                             csv_path: str, unique_field: str, typecast: bool,
+                             csv_engine: str = "python"):
     url = f"https://api.airtable.com/v0/{base_id}/{quote(table_name)}"
     headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
 
-    total, sent, errors = len(rows), 0, 0
-    for i, batch in enumerate(chunked(rows, 10), start=1):
-        payload = {
-            "records": [{"fields": r} for r in batch],
-            "performUpsert": {"fieldsToMergeOn": [unique_field]},
-            "typecast": typecast,
-        }
-        resp = requests.patch(url, headers=headers, data=json.dumps(payload))
-        if not resp.ok:
+    total, sent, errors = 0, 0, 0
+
+    def report(i: int, task: asyncio.Future) -> None:
+        nonlocal sent, errors
+        try:
+            up = task.result()
+        except Exception as e:
             errors += 1
-            print(f"[error] Batch {i} failed: {resp.status_code} {resp.text[:500]}")
+            print(f"[error] Batch {i} failed: {e}")
         else:
-            up = len(resp.json().get("records", []))
             sent += up
             print(f"[ok] Batch {i}: upserted {up}")
 
-        time.sleep(0.2)
+    limiter = AdaptiveLimiter()
+    async with open_session(headers) as session:
+        # Only MAX_IN_FLIGHT batches are held at a time, so memory stays O(batch) however big the CSV is
+        in_flight: Dict[asyncio.Future, int] = {}
+        payload = {
+            "records": [],
+            "performUpsert": {"fieldsToMergeOn": [unique_field]},
+            "typecast": typecast,
+        }
+        shells = [{"fields": None} for _ in range(10)]
+        rows = dedupe_last(lambda log: iter_csv(csv_path, unique_field, engine=csv_engine, log=log),
+                           lambda r: r.get(unique_field), reread=is_regular_file(csv_path))
+        i = 0
+        async for batch in iter_in_thread(chunked(rows, 10), readahead=MAX_IN_FLIGHT):
+            i += 1
+            if len(in_flight) >= MAX_IN_FLIGHT:
+                done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    report(in_flight.pop(task), task)
+            total += len(batch)
+            payload["records"] = fill_shells(shells, "fields", batch)
+            body = orjson.dumps(payload)  # serialized now, so payload and shells can be reused next iteration
+            in_flight[asyncio.ensure_future(send_batch(session, limiter, "PATCH", url, body, f"Batch {i}"))] = i
+        if in_flight:
+            done, _ = await asyncio.wait(in_flight)
+            for task in sorted(done, key=in_flight.get):
+                report(in_flight[task], task)
+
+    if not total:
+        print(f"[warn] No rows in {csv_path}; nothing to upsert.")
+        return
 
     print(f"[done] Upserted {sent}/{total}. Batches with errors: {errors}")
     if errors:
@@ -85,16 +387,20 @@ def main():
     p.add_argument("--csv", required=True)
     p.add_argument("--unique-field", required=True)
     p.add_argument("--typecast", action="store_true")
+    p.add_argument("--csv-engine", choices=sorted(CSV_ENGINES), default="python",
+                   help="CSV parser: python (default), mmap (parallel chunks; no newlines inside "
+                        "quoted fields) or arrow (needs pyarrow; short rows are fatal)")
     args = p.parse_args()
 
-    upsert_to_airtable(
+    asyncio.run(upsert_to_airtable(
         base_id=args.base,
         table_name=args.table,
         token=args.token,
         csv_path=args.csv,
         unique_field=args.unique_field,
         typecast=args.typecast,
-    )
+        csv_engine=args.csv_engine,
+    ))
 
 if __name__ == "__main__":
     main()
@@ -36,15 +36,28 @@ Example:
 """
 
 import argparse
+import asyncio
+import contextlib
 import csv
+import os
+import sqlite3
 import sys
 import time
-from typing import Dict, Iterable, List, Optional, Tuple, Set
-from datetime import datetime
-import requests
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple, Set, Union
+from datetime import datetime, timezone
+import httpx
 
 DEFAULT_PER_PAGE = 100
+DEFAULT_CONCURRENCY = 10
+DEFAULT_STUDENT_BATCH = 100      # students exported per round; bounds memory and sets CSV write cadence
 RETRY_STATUS = {429, 500, 502, 503, 504}
+KEEPALIVE_TIMEOUT = 60.0
+LOW_QUOTA = 50.0                 # X-Rate-Limit-Remaining below which each request pauses before freeing its slot
+SUBMISSIONS_STUDENT_BATCH = 50   # student_ids[] per submissions request, keeps URLs short
+DEFAULT_CACHE_MAX_AGE_DAYS = 7  # --cache-db entries not seen for this long are pruned
+
+# Query params: a dict, or (key, value) pairs when a key repeats (e.g. student_ids[])
+Params = Union[Dict, Sequence[Tuple[str, object]]]
 
 def parse_link_header(link_header: str) -> Dict[str, str]:
     links = {}
@@ -70,11 +83,52 @@ def parse_link_header(link_header: str) -> Dict[str, str]:
             links[rel] = url
     return links
 
-def robust_get(session: requests.Session, url: str, headers: Dict[str, str], params: Optional[Dict]=None, max_retries: int=5) -> requests.Response:
+class HttpCache:
+    """sqlite ETag cache of Canvas responses (holds PII: owner-only, pruned after max_age)."""
+    def __init__(self, path: str, max_age: float = DEFAULT_CACHE_MAX_AGE_DAYS * 86400):
+        path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        os.chmod(path, 0o600)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(url TEXT PRIMARY KEY, etag TEXT, body BLOB, link TEXT, ts INTEGER)"
+        )
+        self.pruned = self.conn.execute("DELETE FROM responses WHERE ts < ?", (int(time.time() - max_age),)).rowcount
+        self.conn.commit()
+        self.hits = 0
+
+    def get(self, url: str) -> Optional[Tuple[str, bytes, str]]:
+        return self.conn.execute("SELECT etag, body, link FROM responses WHERE url = ?", (url,)).fetchone()
+
+    def put(self, url: str, etag: str, body: bytes, link: str) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (url, etag, body, link, ts) VALUES (?, ?, ?, ?, ?)",
+            (url, etag, body, link, int(time.time())),
+        )
+
+    def touch(self, url: str) -> None:
+        """Mark a still-valid entry as used, so pruning keeps it."""
+        self.conn.execute("UPDATE responses SET ts = ? WHERE url = ?", (int(time.time()), url))
+
+    def commit(self) -> None:
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
+
+async def robust_get(session: httpx.AsyncClient, url: str, headers: Dict[str, str], params: Optional[Params]=None, max_retries: int=5, cache: Optional[HttpCache]=None) -> httpx.Response:
+    key = str(httpx.URL(url).copy_merge_params(params or {})) if cache else None
+    cached = cache.get(key) if cache else None
+    if cached:
+        headers = {**headers, "If-None-Match": cached[0]}
     delay = 1.0
     for attempt in range(1, max_retries+1):
-        resp = session.get(url, headers=headers, params=params, timeout=120)
-        if resp.status_code in RETRY_STATUS:
+        resp = await session.get(url, headers=headers, params=params)
+        await pace(resp)
+        if is_throttled(resp):
             retry_after = resp.headers.get("Retry-After")
             if retry_after:
                 try:
@@ -82,14 +136,34 @@ def robust_get(session: requests.Session, url: str, headers: Dict[str, str], par
                 except Exception:
                     pass
             print(f"[WARN] HTTP {resp.status_code} on attempt {attempt}; retrying in {delay:.1f}s", flush=True)
-            time.sleep(delay)
+            await asyncio.sleep(delay)
             delay = min(delay * 2, 30.0)
             continue
+        if cached and resp.status_code == 304:
+            cache.hits += 1
+            cache.touch(key)
+            _, body, link = cached
+            return httpx.Response(200, headers={"Link": link} if link else None, content=body, request=resp.request)
         resp.raise_for_status()
+        if cache and resp.headers.get("ETag"):
+            cache.put(key, resp.headers["ETag"], resp.content, resp.headers.get("Link", ""))
         return resp
     resp.raise_for_status()
     return resp
 
+def is_throttled(resp: httpx.Response) -> bool:
+    # Canvas throttles with 403 "Rate Limit Exceeded", not 429
+    return resp.status_code in RETRY_STATUS or (resp.status_code == 403 and "Rate Limit Exceeded" in resp.text)
+
+async def pace(resp: httpx.Response) -> None:
+    """Sleep briefly when Canvas reports the rate-limit bucket is nearly empty."""
+    try:
+        remaining = float(resp.headers.get("X-Rate-Limit-Remaining", ""))
+    except ValueError:
+        return
+    if remaining < LOW_QUOTA:
+        await asyncio.sleep(1.0 - remaining / LOW_QUOTA)
+
 def iso_parse(dt: Optional[str]) -> Optional[datetime]:
     if not dt:
         return None
@@ -98,16 +172,38 @@ def iso_parse(dt: Optional[str]) -> Optional[datetime]:
     except Exception:
         return None
 
-class CanvasClient:
-    def __init__(self, api_url: str, api_key: str):
+class AsyncCanvasClient:
+    def __init__(self, session: httpx.AsyncClient, api_url: str, api_key: str, concurrency: int=DEFAULT_CONCURRENCY, cache: Optional[HttpCache]=None):
         self.api_url = api_url.rstrip("/")
         self.headers = {"Authorization": f"Bearer {api_key}"}
-        self.session = requests.Session()
+        self.session = session
+        self.cache = cache
+        self._sem = asyncio.Semaphore(concurrency)
+        # Course metadata, assignment and observer lists are identical for every student,
+        # so they are fetched once per course id and shared (in-flight fetches included).
+        self._course_cache: Dict[int, asyncio.Future] = {}
+        self._assignments_cache: Dict[int, asyncio.Future] = {}
+        self._observers_cache: Dict[int, asyncio.Future] = {}
+
+    async def _memo(self, cache: Dict[int, asyncio.Future], key: int, make) -> object:
+        fut = cache.get(key)
+        if fut is None:
+            fut = cache[key] = asyncio.ensure_future(make())
+        try:
+            return await fut
+        except Exception:
+            if cache.get(key) is fut:
+                del cache[key]  # don't pin failures; the next caller retries
+            raise
+
+    async def get(self, url: str, params: Optional[Params]=None) -> httpx.Response:
+        async with self._sem:
+            return await robust_get(self.session, url, self.headers, params=params, cache=self.cache)
 
-    def paged_get(self, url: str, params: Optional[Dict]=None) -> Iterable[Dict]:
-        params_local = dict(params or {})
+    async def paged_get(self, url: str, params: Optional[Params]=None) -> AsyncIterator[Dict]:
+        params_local = params
         while True:
-            resp = robust_get(self.session, url, self.headers, params=params_local)
+            resp = await self.get(url, params=params_local)
             params_local = None
             data = resp.json()
             if isinstance(data, list):
@@ -121,35 +217,55 @@ class CanvasClient:
                 break
             url = next_url
 
-    def list_students(self, account_id: str, per_page: int=DEFAULT_PER_PAGE) -> Iterable[Dict]:
+    async def paged_list(self, url: str, params: Optional[Params]=None) -> List[Dict]:
+        return [item async for item in self.paged_get(url, params)]
+
+    async def list_students(self, account_id: str, per_page: int=DEFAULT_PER_PAGE, include_last_login: bool=False) -> AsyncIterator[Dict]:
         url = f"{self.api_url}/accounts/{account_id}/users"
         params = {"enrollment_type[]": "student", "per_page": per_page}
-        yield from self.paged_get(url, params)
+        if include_last_login:
+            params["include[]"] = "last_login"
+        async for user in self.paged_get(url, params):
+            yield user
 
-    def list_student_enrollments(self, user_id: int, per_page: int=DEFAULT_PER_PAGE) -> Iterable[Dict]:
+    async def list_student_enrollments(self, user_id: int, per_page: int=DEFAULT_PER_PAGE) -> List[Dict]:
         url = f"{self.api_url}/users/{user_id}/enrollments"
         params = {"type[]": "StudentEnrollment", "include[]": "grades", "per_page": per_page}
-        yield from self.paged_get(url, params)
+        return await self.paged_list(url, params)
 
-    def get_course(self, course_id: int) -> Dict:
+    async def get_course(self, course_id: int) -> Dict:
         url = f"{self.api_url}/courses/{course_id}"
-        resp = robust_get(self.session, url, self.headers)
+        resp = await self.get(url)
         return resp.json()
 
-    def list_course_assignments(self, course_id: int, per_page: int=DEFAULT_PER_PAGE) -> Iterable[Dict]:
+    async def get_course_cached(self, course_id: int) -> Dict:
+        return await self._memo(self._course_cache, course_id, lambda: self.get_course(course_id))
+
+    async def list_course_assignments(self, course_id: int, per_page: int=DEFAULT_PER_PAGE) -> List[Dict]:
         url = f"{self.api_url}/courses/{course_id}/assignments"
         params = {"per_page": per_page}
-        yield from self.paged_get(url, params)
+        return await self.paged_list(url, params)
+
+    async def list_course_assignments_cached(self, course_id: int, per_page: int=DEFAULT_PER_PAGE) -> Tuple[Dict, ...]:
+        async def fetch() -> Tuple[Dict, ...]:
+            return tuple(await self.list_course_assignments(course_id, per_page=per_page))
+        return await self._memo(self._assignments_cache, course_id, fetch)
 
-    def list_student_submissions(self, course_id: int, user_id: int, per_page: int=DEFAULT_PER_PAGE) -> Iterable[Dict]:
+    async def list_course_submissions(self, course_id: int, user_ids: List[int], per_page: int=DEFAULT_PER_PAGE) -> List[Dict]:
         url = f"{self.api_url}/courses/{course_id}/students/submissions"
-        params = {"student_ids[]": user_id, "per_page": per_page, "include[]": "submission_history"}
-        yield from self.paged_get(url, params)
+        params = [("student_ids[]", uid) for uid in user_ids]
+        params += [("per_page", per_page), ("include[]", "submission_history")]
+        return await self.paged_list(url, params)
 
-    def list_course_observer_enrollments(self, course_id: int, per_page: int=DEFAULT_PER_PAGE) -> Iterable[Dict]:
+    async def list_course_observer_enrollments(self, course_id: int, per_page: int=DEFAULT_PER_PAGE) -> List[Dict]:
         url = f"{self.api_url}/courses/{course_id}/enrollments"
         params = {"type[]": "ObserverEnrollment", "per_page": per_page, "include[]": "user"}
-        yield from self.paged_get(url, params)
+        return await self.paged_list(url, params)
+
+    async def list_course_observer_enrollments_cached(self, course_id: int, per_page: int=DEFAULT_PER_PAGE) -> Tuple[Dict, ...]:
+        async def fetch() -> Tuple[Dict, ...]:
+            return tuple(await self.list_course_observer_enrollments(course_id, per_page=per_page))
+        return await self._memo(self._observers_cache, course_id, fetch)
 
 def split_first_last(name: Optional[str], sortable_name: Optional[str]) -> Tuple[str, str]:
     sname = (sortable_name or "").strip()
@@ -167,7 +283,35 @@ def split_first_last(name: Optional[str], sortable_name: Optional[str]) -> Tuple
 def pick_email(user: Dict) -> str:
     return (user.get("email") or user.get("login_id") or "").strip()
 
-def build_summary_for_student(client: CanvasClient, user: Dict, include_assignments: bool, per_page: int) -> Dict:
+async def fetch_course_data(client: AsyncCanvasClient, cid: int, user_ids: List[int], include_assignments: bool, per_page: int) -> Dict[str, object]:
+    """Fetch one course's data for all its students; values are data or the exception raised."""
+    async def submissions_by_user() -> Dict[int, List[Dict]]:
+        batches = [user_ids[i:i + SUBMISSIONS_STUDENT_BATCH] for i in range(0, len(user_ids), SUBMISSIONS_STUDENT_BATCH)]
+        by_user: Dict[int, List[Dict]] = {uid: [] for uid in user_ids}
+        for subs in await asyncio.gather(*(client.list_course_submissions(cid, b, per_page=per_page) for b in batches)):
+            for sub in subs:
+                by_user.setdefault(int(sub.get("user_id") or 0), []).append(sub)
+        return by_user
+
+    async def observers_by_student() -> Dict[int, List[Dict]]:
+        by_student: Dict[int, List[Dict]] = {}
+        for obs in await client.list_course_observer_enrollments_cached(cid, per_page=per_page):
+            by_student.setdefault(int(obs.get("associated_user_id") or 0), []).append(obs)
+        return by_student
+
+    async def none() -> None:
+        return None
+
+    course, assignments, submissions, observers = await asyncio.gather(
+        client.get_course_cached(cid),
+        client.list_course_assignments_cached(cid, per_page=per_page) if include_assignments else none(),
+        submissions_by_user() if include_assignments else none(),
+        observers_by_student(),
+        return_exceptions=True,
+    )
+    return {"course": course, "assignments": assignments, "submissions": submissions, "observers": observers}
+
+def build_summary_for_student(user: Dict, enrollments: List[Dict], course_data: Dict[int, Dict[str, object]], include_assignments: bool) -> Dict:
     user_id = int(user["id"])
     first, last = split_first_last(user.get("name"), user.get("sortable_name"))
     email = pick_email(user)
@@ -182,8 +326,9 @@ def build_summary_for_student(client: CanvasClient, user: Dict, include_assignme
     course_names = []
     total_assignments = 0
     completed_assignments = 0
+    observer_linked = "No"
+    parent_first = parent_last = parent_email = ""
 
-    enrollments = list(client.list_student_enrollments(user_id, per_page=per_page))
     print(f"[INFO]  Found {len(enrollments)} enrollments for student {user_id}", flush=True)
 
     for idx, enr in enumerate(enrollments, start=1):
@@ -196,27 +341,42 @@ def build_summary_for_student(client: CanvasClient, user: Dict, include_assignme
         if created_at and (earliest_enrollment is None or created_at < earliest_enrollment):
             earliest_enrollment = created_at
 
-        try:
-            course = client.get_course(cid)
+        data = course_data[cid]
+        course = data["course"]
+        if isinstance(course, Exception):
+            print(f"[WARN]   [{idx}/{len(enrollments)}] Failed to fetch course {cid}: {course}", flush=True)
+        else:
             cname = course.get("name") or str(cid)
             course_names.append(cname)
             print(f"[INFO]   [{idx}/{len(enrollments)}] Course: {cname} (ID {cid})", flush=True)
-        except Exception as e:
-            print(f"[WARN]   [{idx}/{len(enrollments)}] Failed to fetch course {cid}: {e}", flush=True)
+
+        # Observer → Parent fields
+        observers = data["observers"]
+        if isinstance(observers, Exception):
+            print(f"[WARN]   Observer lookup error for student {user_id} in course {cid}: {observers}", flush=True)
+        else:
+            for obs in observers.get(user_id, []):
+                observer_linked = "Yes"
+                u = obs.get("user") or {}
+                pf, pl = split_first_last(u.get("name"), u.get("sortable_name"))
+                parent_first = parent_first or pf
+                parent_last = parent_last or pl
+                parent_email = parent_email or pick_email(u)
 
         if include_assignments:
-            try:
-                assignments = list(client.list_course_assignments(cid, per_page=per_page))
-                total_assignments += len(assignments)
-                print(f"[INFO]     Assignments found: {len(assignments)}", flush=True)
-                submitted = 0
-                for sub in client.list_student_submissions(cid, user_id, per_page=per_page):
-                    if sub.get("submitted_at") or sub.get("workflow_state") in ("submitted", "graded"):
-                        submitted += 1
-                completed_assignments += submitted
-                print(f"[INFO]     Completed assignments for this course: {submitted}", flush=True)
-            except Exception as e:
-                print(f"[WARN]     Could not fetch assignments/submissions for course {cid}: {e}", flush=True)
+            assignments, submissions = data["assignments"], data["submissions"]
+            err = next((r for r in (assignments, submissions) if isinstance(r, Exception)), None)
+            if err is not None:
+                print(f"[WARN]     Could not fetch assignments/submissions for course {cid}: {err}", flush=True)
+                continue
+            total_assignments += len(assignments)
+            print(f"[INFO]     Assignments found: {len(assignments)}", flush=True)
+            submitted = 0
+            for sub in submissions.get(user_id, []):
+                if sub.get("submitted_at") or sub.get("workflow_state") in ("submitted", "graded"):
+                    submitted += 1
+            completed_assignments += submitted
+            print(f"[INFO]     Completed assignments for this course: {submitted}", flush=True)
 
     total_courses = len(course_ids)
     overall_status = ""
@@ -228,23 +388,6 @@ def build_summary_for_student(client: CanvasClient, user: Dict, include_assignme
         else:
             overall_status = ",".join(sorted(set([s for s in statuses if s])))
 
-    # Observer → Parent fields
-    observer_linked = "No"
-    parent_first = parent_last = parent_email = ""
-    try:
-        for cid in list(course_ids)[:10]:  # limit to reduce API calls
-            for obs in client.list_course_observer_enrollments(cid, per_page=per_page):
-                if int(obs.get("associated_user_id") or 0) != user_id:
-                    continue
-                observer_linked = "Yes"
-                u = obs.get("user") or {}
-                pf, pl = split_first_last(u.get("name"), u.get("sortable_name"))
-                parent_first = parent_first or pf
-                parent_last = parent_last or pl
-                parent_email = parent_email or pick_email(u)
-    except Exception as e:
-        print(f"[WARN]   Observer lookup error for student {user_id}: {e}", flush=True)
-
     progress_pct = ""
     if include_assignments and total_assignments > 0:
         progress_pct = round(100.0 * completed_assignments / total_assignments, 2)
@@ -274,6 +417,14 @@ def build_summary_for_student(client: CanvasClient, user: Dict, include_assignme
         "Course Names": "; ".join(sorted(course_names)),
     }
 
+def parse_since(s: Optional[str]) -> Optional[datetime]:
+    if not s:
+        return None
+    since = iso_parse(s)
+    if since is None:
+        sys.exit(f"[ERROR] --since must be an ISO date or datetime, got {s!r}")
+    return since if since.tzinfo else since.replace(tzinfo=timezone.utc)
+
 def parse_id_set(s: Optional[str], caster) -> Optional[Set]:
     if not s:
         return None
@@ -288,21 +439,35 @@ def parse_id_set(s: Optional[str], caster) -> Optional[Set]:
             out.add(part)
     return out if out else None
 
-def main():
-    parser = argparse.ArgumentParser(description="Export one CSV per student with profile + parent + aggregated course stats (with progress logs).")
-    parser.add_argument("--api-url", required=True)
-    parser.add_argument("--api-key", required=True)
-    parser.add_argument("--account-id", default="self")
-    parser.add_argument("--out", default="Students_AllInOne.csv")
-    parser.add_argument("--per-page", type=int, default=DEFAULT_PER_PAGE)
-    parser.add_argument("--include-canvas-ids", default=None, help='Comma-separated Canvas user IDs, e.g., "851,2220,951"')
-    parser.add_argument("--include-sis-ids", default=None, help='Comma-separated SIS user IDs, e.g., "S1234,S2345"')
-    parser.add_argument("--include-assignments", action="store_true", help="Fetch assignments & submissions to compute totals/progress")
-    args = parser.parse_args()
-
-    client = CanvasClient(args.api_url, args.api_key)
+async def export_students(client: AsyncCanvasClient, students: List[Dict], w: csv.DictWriter, include_assignments: bool, per_page: int) -> None:
+    """Fetch and write the summary rows for one batch of students."""
+    # Pass 1: enrollments per student, inverted into course -> students
+    enrollments_by_student = await asyncio.gather(*(
+        client.list_student_enrollments(int(user["id"]), per_page=per_page) for user in students
+    ))
+    course_students: Dict[int, Dict[int, None]] = {}  # dict as an ordered set of user ids
+    for user, enrollments in zip(students, enrollments_by_student):
+        for enr in enrollments:
+            cid = enr.get("course_id")
+            if cid:
+                course_students.setdefault(cid, {})[int(user["id"])] = None
+    print(f"[INFO] {len(students)} students span {len(course_students)} courses", flush=True)
+
+    # Pass 2: one fan-out per course, shared by every student in the batch enrolled in it
+    course_data = dict(zip(course_students, await asyncio.gather(*(
+        fetch_course_data(client, cid, list(uids), include_assignments, per_page)
+        for cid, uids in course_students.items()
+    ))))
+
+    for user, enrollments in zip(students, enrollments_by_student):
+        row = build_summary_for_student(user, enrollments, course_data, include_assignments=include_assignments)
+        w.writerow(row)
+        print(f"[INFO] Wrote row for student {user['id']} ({row['Student First Name']} {row['Student Last Name']})", flush=True)
+
+async def export(args: argparse.Namespace) -> None:
     include_canvas_ids = parse_id_set(args.include_canvas_ids, int) if args.include_canvas_ids else None
     include_sis_ids = parse_id_set(args.include_sis_ids, str) if args.include_sis_ids else None
+    since = parse_since(args.since)
 
     fieldnames = [
         "Student First Name", "Student Last Name", "Student ID nese ka (per SCS)",
@@ -314,37 +479,82 @@ def main():
         "Total courses enrolled", "Progress", "Enrollment status", "Course Names",
     ]
 
-    rows = []
     total_students = 0
     matched_students = 0
-
-    print("[INFO] Starting export...", flush=True)
-    for user in client.list_students(args.account_id, per_page=args.per_page):
-        total_students += 1
-        uid_raw = user.get("id")
-        if not uid_raw:
-            continue
-        uid = int(uid_raw)
-        sis = (user.get("sis_user_id") or "").strip()
-
-        # Apply filters (if any)
-        if include_canvas_ids and uid not in include_canvas_ids:
-            continue
-        if include_sis_ids and ((sis == "") or (sis not in include_sis_ids)):
-            continue
-
-        matched_students += 1
-        row = build_summary_for_student(client, user, include_assignments=args.include_assignments, per_page=args.per_page)
-        rows.append(row)
-        print(f"[INFO] Wrote row for student {uid} ({row['Student First Name']} {row['Student Last Name']})", flush=True)
-
-    with open(args.out, "w", newline="", encoding="utf-8") as f:
+    dormant_students = 0
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency,
+                          keepalive_expiry=KEEPALIVE_TIMEOUT)
+    cache = HttpCache(args.cache_db, max_age=args.cache_max_age * 86400) if args.cache_db else None
+    if cache and cache.pruned:
+        print(f"[INFO] Pruned {cache.pruned} cached responses unused for {args.cache_max_age:g} days", flush=True)
+    # Rows are written (and flushed) batch by batch, so a crash mid-export leaves a usable partial CSV
+    with open(args.out, "w", newline="", encoding="utf-8") as f, \
+            (contextlib.closing(cache) if cache else contextlib.nullcontext()):
         w = csv.DictWriter(f, fieldnames=fieldnames)
         w.writeheader()
-        w.writerows(rows)
+        async with httpx.AsyncClient(http2=True, limits=limits, timeout=120, follow_redirects=True) as session:
+            client = AsyncCanvasClient(session, args.api_url, args.api_key, concurrency=args.concurrency, cache=cache)
+
+            print("[INFO] Starting export...", flush=True)
+            batch = []
+            async for user in client.list_students(args.account_id, per_page=args.per_page, include_last_login=since is not None):
+                total_students += 1
+                uid_raw = user.get("id")
+                if not uid_raw:
+                    continue
+                uid = int(uid_raw)
+                sis = (user.get("sis_user_id") or "").strip()
 
+                # Apply filters (if any)
+                if include_canvas_ids and uid not in include_canvas_ids:
+                    continue
+                if include_sis_ids and ((sis == "") or (sis not in include_sis_ids)):
+                    continue
+                # Dormant users cost an enrollments GET each, usually for nothing
+                if since:
+                    last_login = iso_parse(user.get("last_login"))
+                    if last_login is None or last_login < since:
+                        dormant_students += 1
+                        continue
+
+                matched_students += 1
+                batch.append(user)
+                if len(batch) >= args.student_batch:
+                    await export_students(client, batch, w, args.include_assignments, args.per_page)
+                    f.flush()
+                    if cache:
+                        cache.commit()  # a killed run keeps what it has cached so far
+                    batch = []
+            if batch:
+                await export_students(client, batch, w, args.include_assignments, args.per_page)
+
+    if cache:
+        print(f"[INFO] {cache.hits} Canvas responses unchanged since last run (served from {args.cache_db})", flush=True)
+    if since:
+        print(f"[INFO] Skipped {dormant_students} students with no login since {since.isoformat()}", flush=True)
     print(f"[INFO] Export complete. Matched {matched_students} students (scanned {total_students}). Wrote: {args.out}", flush=True)
 
+def main():
+    parser = argparse.ArgumentParser(description="Export one CSV per student with profile + parent + aggregated course stats (with progress logs).")
+    parser.add_argument("--api-url", required=True)
+    parser.add_argument("--api-key", required=True)
+    parser.add_argument("--account-id", default="self")
+    parser.add_argument("--out", default="Students_AllInOne.csv")
+    parser.add_argument("--per-page", type=int, default=DEFAULT_PER_PAGE)
+    parser.add_argument("--include-canvas-ids", default=None, help='Comma-separated Canvas user IDs, e.g., "851,2220,951"')
+    parser.add_argument("--include-sis-ids", default=None, help='Comma-separated SIS user IDs, e.g., "S1234,S2345"')
+    parser.add_argument("--since", default=None, help='Skip students who have not logged in since this ISO date, e.g., "2025-08-01"')
+    parser.add_argument("--include-assignments", action="store_true", help="Fetch assignments & submissions to compute totals/progress")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Max in-flight Canvas requests")
+    parser.add_argument("--student-batch", type=int, default=DEFAULT_STUDENT_BATCH, help="Students fetched and written per round")
+    parser.add_argument("--cache-db", default=None, help="Opt-in sqlite file caching Canvas responses by ETag across runs, "
+                                                         "e.g. ~/.cache/canvas-sync.db (stores student/parent PII)")
+    parser.add_argument("--cache-max-age", type=float, default=DEFAULT_CACHE_MAX_AGE_DAYS, help="Days an unused --cache-db entry is kept")
+    args = parser.parse_args()
+
+    asyncio.run(export(args))
+
 if __name__ == "__main__":
     main()
 
@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
-import os, csv, requests, time, sys, json
+import os, csv, sys, json, asyncio
 from urllib.parse import quote
+import orjson
+from airtable_upsert import MAX_IN_FLIGHT, AdaptiveLimiter, dedupe_last, fill_shells, is_regular_file, iter_in_thread, open_session, request_json, send_batch
 
 """
 Generic CSV → Airtable upsert
-- Uses a unique key column present in the CSV to decide update vs create.
+- Upserts on a unique key column present in the CSV via Airtable's performUpsert,
+  so Airtable decides update vs create server-side (no read of the table needed).
+  Airtable rejects a batch if a key matches several records in the table, so the
+  table's keys must be unique (soft-delete mode warns about duplicates it finds).
 - Optional soft-delete: mark missing records as Active=False if AIRTABLE_SOFT_DELETE=true
   and the table has an 'Active' checkbox.
+- CSV parsing (on a reader thread) and uploading run as one asyncio pipeline.
 
 Env:
   AIRTABLE_PAT
@@ -18,10 +24,156 @@ Env:
   AIRTABLE_SOFT_DELETE  (optional: 'true'/'false'; default false)
 """
 
+ROW_QUEUE_SIZE = 1000
+
 def batched(lst, n=10):
     for i in range(0, len(lst), n):
         yield lst[i:i+n]
 
+async def iter_records(session, limiter, api):
+    """Yield every record in the table, following Airtable's offset pagination."""
+    offset = None
+    while True:
+        params = {"pageSize": 100}
+        if offset: params["offset"] = offset
+        data = await request_json(session, limiter, "GET", api, "Read existing", params=params)
+        for rec in data.get("records", []):
+            yield rec
+        offset = data.get("offset")
+        if not offset:
+            break
+
+def read_rows(csv_path):
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        yield from csv.DictReader(f)
+
+async def csv_reader(csv_path, unique_key, row_queue):
+    # Only the last row per key is sent; Airtable rejects a batch that repeats a merge key
+    rows = dedupe_last(lambda log: read_rows(csv_path), lambda r: (r.get(unique_key) or "").strip(),
+                       reread=is_regular_file(csv_path))
+    async for row in iter_in_thread(rows):
+        await row_queue.put(row)
+    await row_queue.put(None)
+
+async def upsert_batch(session, limiter, api, body, label):
+    """PATCH one performUpsert batch; returns (updated, created) counts from Airtable's reply."""
+    data = await request_json(session, limiter, "PATCH", api, label, body=body)
+    return len(data.get("updatedRecords", [])), len(data.get("createdRecords", []))
+
+async def uploader(session, limiter, api, unique_key, typecast, row_queue, current_keys):
+    """Batch queued rows into performUpsert PATCHes, at most MAX_IN_FLIGHT pending."""
+    in_flight, pending = set(), []
+    sent, updated, created = 0, 0, 0
+    payload = {
+        "records": [],
+        "performUpsert": {"fieldsToMergeOn": [unique_key]},
+        "typecast": typecast,
+    }
+    shells = [{"fields": None} for _ in range(10)]
+
+    async def drain(return_when):
+        nonlocal updated, created
+        done, _ = await asyncio.wait(in_flight, return_when=return_when)
+        for task in done:
+            in_flight.discard(task)
+            u, c = task.result()
+            updated += u
+            created += c
+
+    async def dispatch():
+        nonlocal pending, sent
+        if len(in_flight) >= MAX_IN_FLIGHT:
+            await drain(asyncio.FIRST_COMPLETED)
+        payload["records"], pending = fill_shells(shells, "fields", pending), []
+        sent += 1
+        in_flight.add(asyncio.ensure_future(
+            upsert_batch(session, limiter, api, orjson.dumps(payload), f"Upsert batch {sent}")))
+
+    try:
+        while (row := await row_queue.get()) is not None:
+            k = (row.get(unique_key) or "").strip()
+            if not k:
+                continue
+            current_keys.add(k)
+            row[unique_key] = k
+            pending.append(row)
+            if len(pending) == 10:
+                await dispatch()
+        if pending:
+            await dispatch()
+        while in_flight:
+            await drain(asyncio.FIRST_COMPLETED)
+    finally:
+        for task in in_flight:
+            task.cancel()
+    return updated, created
+
+async def read_existing(session, limiter, api, unique_key):
+    """Map each unique key already in the table to its record ids."""
+    existing = {}
+    async for rec in iter_records(session, limiter, api):
+        k = (rec.get("fields", {}).get(unique_key) or "").strip()
+        if k:
+            existing.setdefault(k, []).append(rec["id"])
+    return existing
+
+def warn_duplicates(existing, table, unique_key):
+    """performUpsert rejects a batch whose key matches several records, so name those keys."""
+    dupes = [k for k, ids in existing.items() if len(ids) > 1]
+    if dupes:
+        print(f"[warn] {len(dupes)} '{unique_key}' values match more than one record in '{table}' "
+              f"(e.g. {dupes[:5]}); Airtable rejects upserts on those keys until the duplicates are removed.")
+
+async def soft_delete(session, limiter, api, existing, current_keys):
+    stale_keys = existing.keys() - current_keys
+    to_mark = [rid for k in stale_keys for rid in existing[k]]
+    payload = {"records": [], "typecast": True}
+    inactive = {"Active": False}
+    shells = [{"id": None, "fields": inactive} for _ in range(10)]
+    tasks = []
+    for i, batch_ids in enumerate(batched(to_mark, 10), start=1):
+        payload["records"] = fill_shells(shells, "id", batch_ids)
+        tasks.append(send_batch(session, limiter, "PATCH", api, orjson.dumps(payload), f"Soft-delete batch {i}"))
+    await asyncio.gather(*tasks)
+
+async def run(api, hdr, table, csv_path, unique_key, typecast, do_softdel):
+    limiter = AdaptiveLimiter()
+    async with open_session(hdr) as session:
+        # 1) Read CSV and 2) upsert it, concurrently
+        row_queue = asyncio.Queue(maxsize=ROW_QUEUE_SIZE)
+        current_keys = set()
+        # Snapshot the table alongside the upload: a record this run creates has a current key,
+        # so it can never be stale, and the snapshot needn't wait for the upload to finish
+        existing = asyncio.ensure_future(read_existing(session, limiter, api, unique_key)) if do_softdel else None
+        try:
+            _, (total_upd, total_new) = await asyncio.gather(
+                csv_reader(csv_path, unique_key, row_queue),
+                uploader(session, limiter, api, unique_key, typecast, row_queue, current_keys),
+            )
+        except RuntimeError as e:
+            print(f"[error] Upsert failed: {e}")
+            if str(e).startswith("422"):
+                print(f"[error] A 422 from performUpsert usually means more than one record in '{table}' "
+                      f"has the same '{unique_key}' (or a CSV column is not a field of the table).")
+            if existing and existing.done() and not existing.cancelled() and not existing.exception():
+                warn_duplicates(existing.result(), table, unique_key)
+            elif existing:
+                existing.cancel()
+            raise
+
+        print(f"[ok] Upsert complete. Updated={total_upd}, Created={total_new}")
+
+        # 3) Optional soft-delete
+        if do_softdel:
+            try:
+                existing = await existing
+                warn_duplicates(existing, table, unique_key)
+                await soft_delete(session, limiter, api, existing, current_keys)
+                print("[ok] Soft-delete complete (Active=False).")
+            except RuntimeError as e:
+                print(f"[warn] Soft-delete skipped: {e}. Add an 'Active' checkbox to '{table}'.")
+                # don’t fail the job
+
 def main():
     base  = os.environ["AIRTABLE_BASE_ID"]
     table = os.environ["AIRTABLE_TABLE_NAME"]
@@ -34,107 +186,7 @@ def main():
     api  = f"https://api.airtable.com/v0/{base}/{quote(table, safe='')}"
     hdr  = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
 
-    # 1) Read CSV
-    with open(csv_path, newline="", encoding="utf-8") as f:
-        rows = list(csv.DictReader(f))
-
-    # 2) Pull existing [unique_key -> id]
-    existing = {}
-    offset = None
-    sess = requests.Session()
-    while True:
-        params = {"pageSize": 100}
-        if offset: params["offset"] = offset
-        r = sess.get(api, headers=hdr, params=params, timeout=60)
-        if not r.ok:
-            print(f"[error] Read existing failed {r.status_code}: {r.text[:300]}")
-            r.raise_for_status()
-        data = r.json()
-        for rec in data.get("records", []):
-            k = (rec.get("fields",{}).get(unique_key) or "").strip()
-            if k:
-                existing[k] = rec["id"]
-        offset = data.get("offset")
-        if not offset:
-            break
-
-    # 3) Split updates vs creates
-    updates, creates = [], []
-    current_keys = set()
-    for row in rows:
-        k = (row.get(unique_key) or "").strip()
-        if not k:
-            continue
-        current_keys.add(k)
-        if k in existing:
-            updates.append({"id": existing[k], "fields": row})
-        else:
-            creates.append({"fields": row})
-
-    # 4) PATCH updates
-    total_upd = total_new = 0
-    for batch in batched(updates, 10):
-        r = sess.patch(api, headers=hdr, json={"records": batch, "typecast": typecast}, timeout=60)
-        if r.status_code in (429,500,502,503,504):
-            time.sleep(2)
-            r = sess.patch(api, headers=hdr, json={"records": batch, "typecast": typecast}, timeout=60)
-        if not r.ok:
-            print(f"[error] PATCH failed {r.status_code}: {r.text[:300]}")
-            r.raise_for_status()
-        total_upd += len(batch)
-
-    # 5) POST creates
-    for batch in batched(creates, 10):
-        r = sess.post(api, headers=hdr, json={"records": batch, "typecast": typecast}, timeout=60)
-        if r.status_code in (429,500,502,503,504):
-            time.sleep(2)
-            r = sess.post(api, headers=hdr, json={"records": batch, "typecast": typecast}, timeout=60)
-        if not r.ok:
-            print(f"[error] POST failed {r.status_code}: {r.text[:300]}")
-            r.raise_for_status()
-        total_new += len(batch)
-
-    print(f"[ok] Upsert complete. Updated={total_upd}, Created={total_new}")
-
-    # 6) Optional soft-delete
-    if do_softdel:
-        try:
-            # Re-fetch all to get [id, key]
-            pairs = []
-            offset = None
-            while True:
-                params = {"pageSize": 100}
-                if offset: params["offset"] = offset
-                r = sess.get(api, headers={"Authorization": f"Bearer {token}"}, params=params, timeout=60)
-                r.raise_for_status()
-                j = r.json()
-                for rec in j.get("records", []):
-                    fields = rec.get("fields", {})
-                    k = (fields.get(unique_key) or "").strip()
-                    if k:
-                        pairs.append((rec["id"], k))
-                offset = j.get("offset")
-                if not offset:
-                    break
-
-            to_mark = [rid for rid, k in pairs if k and (k not in current_keys)]
-            for batch_ids in batched(to_mark, 10):
-                batch = [{"id": rid, "fields": {"Active": False}} for rid in batch_ids]
-                r = sess.patch(api,
-                               headers={"Authorization": f"Bearer {token}", "Content-Type":"application/json"},
-                               json={"records": batch, "typecast": True},
-                               timeout=60)
-                if r.status_code in (429,500,502,503,504):
-                    time.sleep(2)
-                    r = sess.patch(api,
-                                   headers={"Authorization": f"Bearer {token}", "Content-Type":"application/json"},
-                                   json={"records": batch, "typecast": True},
-                                   timeout=60)
-                r.raise_for_status()
-            print("[ok] Soft-delete complete (Active=False).")
-        except requests.HTTPError as e:
-            print(f"[warn] Soft-delete skipped: {e}. Add an 'Active' checkbox to '{table}'.")
-            # don’t fail the job
+    asyncio.run(run(api, hdr, table, csv_path, unique_key, typecast, do_softdel))
 
 if __name__ == "__main__":
     main()